@@ -5,20 +5,52 @@ A debugger to read the decrypted cached data.
 
 # ======================================================================
 
-import json
+import base64
 import os
 import sys
 from pathlib import Path
 
-from cryptography.fernet import Fernet, InvalidToken
+try:
+    # optional: parses and serializes much faster than the stdlib `json`
+    import orjson
+
+    def _pretty_json(decoded_data_bytes):
+        data = orjson.loads(decoded_data_bytes)
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+except ImportError:
+    import json
+
+    def _pretty_json(decoded_data_bytes):
+        data = json.loads(decoded_data_bytes)
+        return json.dumps(data, indent=2).encode("utf-8")
+
+try:
+    # optional: the Rust-backed binding is faster and much lighter to import
+    from rfernet import DecryptionError as InvalidToken
+    from rfernet import Fernet
+
+    def _decrypt(key, token):
+        # `rfernet` only accepts `str` tokens
+        return Fernet(key).decrypt(token.decode("ascii"))
+
+except ImportError:
+    from cryptography.fernet import Fernet, InvalidToken
+
+    def _decrypt(key, token):
+        return Fernet(key).decrypt(token)
+
 
 # ======================================================================
 
 # yapf: disable
 HELP_USAGE = (
-    f'Usage: python {Path(__file__).name} FILE [OUTPUT_FILE]\n'
+    f'Usage: python {Path(__file__).name} [--raw] FILE [OUTPUT_FILE]\n'
+    '\n'
+    '  Read, unencrypt, and output the given file.\n'
     '\n'
-    '  Read, unencrypt, and output the given file.'
+    'Options:\n'
+    '  --raw  Output the data as stored, without pretty-printing it.'
 )
 # yapf: enable
 
@@ -31,6 +63,11 @@ def main():
     if len(args) == 0 or any(arg in ("-h", "--help") for arg in args):
         print(HELP_USAGE)
         return
+    raw = "--raw" in args
+    args = [arg for arg in args if arg != "--raw"]
+    if len(args) == 0:
+        print(HELP_USAGE)
+        return
 
     filepath = Path(args[0])
     if not filepath.exists():
@@ -43,22 +80,28 @@ def main():
         return
 
     encoded_data_bytes = filepath.read_bytes()
+    if encoded_data_bytes.startswith(b"\x80"):
+        # the raw token bytes (the Fernet version byte); older files store the
+        # token base64-encoded
+        encoded_data_bytes = base64.urlsafe_b64encode(encoded_data_bytes)
     try:
-        crypto = Fernet(decryption_key)
-        decoded_data_bytes = crypto.decrypt(encoded_data_bytes)
+        decoded_data_bytes = _decrypt(decryption_key, encoded_data_bytes)
     except (ValueError, InvalidToken):
         print("Error: Invalid decryption key used for stored data")
         return
 
-    data = json.loads(decoded_data_bytes)
-    data_str = json.dumps(data, indent=2)
+    if raw:
+        # the decrypted data is already valid JSON
+        data_bytes = decoded_data_bytes
+    else:
+        data_bytes = _pretty_json(decoded_data_bytes)
 
     if len(args) >= 2:
         output_filepath = Path(args[1])
-        output_filepath.write_text(data_str, encoding="utf-8")
+        output_filepath.write_bytes(data_bytes)
     else:
         # print it nicely
-        print(data_str)
+        print(data_bytes.decode("utf-8"))
 
 
 if __name__ == "__main__":
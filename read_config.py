@@ -7,13 +7,16 @@ This file can be run to validate the codePost courses in the file.
 
 # ==============================================================================
 
+import functools
 import os
+import string
 import sys
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
 import codepost
-import pytz
 import yaml
 from slack_sdk.errors import SlackApiError
 
@@ -28,14 +31,32 @@ __all__ = ('read',)
 
 CONFIG_FILE = Path('config.yaml')
 
-UTC_TZ = pytz.utc
-EASTERN_TZ = pytz.timezone('US/Eastern')
+UTC_TZ = timezone.utc
+EASTERN_TZ = ZoneInfo('America/New_York')
 DATE_FMT = '%Y-%m-%d'
 DEADLINE_FMT = '%Y-%m-%d %H:%M'
 
 NO_DAY = timedelta()
 ONE_DAY = timedelta(days=1)
 
+# the maximum number of concurrent Slack requests when validating channels
+SLACK_MAX_WORKERS = 8
+
+# the required str keys of a course
+COURSE_STR_KEYS = ('course', 'period', 'channel')
+# the str keys of an assignment, and whether they are required
+ASSIGNMENT_STR_KEYS = (
+    ('name', True),
+    ('start', False),
+    ('end', False),
+    ('deadline', False),
+)
+# the date keys of an assignment, and the offset to apply to the parsed date
+ASSIGNMENT_DATE_KEYS = (
+    ('start', NO_DAY),
+    ('end', ONE_DAY),
+)
+
 # ==============================================================================
 
 # the support messages and the required keys, with test values to validate the
@@ -63,51 +84,159 @@ MESSAGES_KWARGS = {
     },
 }
 
+# the supported variable keys of each message, computed once
+MESSAGES_FIELDS = {
+    key: frozenset(kwargs) for key, kwargs in MESSAGES_KWARGS.items()
+}
+
 # ==============================================================================
 
 
-def _validate_slack_channels(slack_client, channels, fmt_error):
+def _get_fields_error(fmt_str, fields):
+    """Checks the variable keys used in the given format string against the
+    given fields. Returns an error message if there are positional fields or
+    unknown keys, or None. Raises a ValueError if the format string is
+    malformed.
+    """
+    unknown = set()
+    for _, field_name, _, _ in string.Formatter().parse(fmt_str):
+        if field_name is None:
+            # literal text only
+            continue
+        # only the start of a field name such as "graders[0]" or "done.real" is
+        # the variable key
+        var_key = field_name.partition('.')[0].partition('[')[0]
+        if var_key == '' or var_key.isdigit():
+            # such as "{}" or "{0}"
+            return 'Positional fields are not allowed'
+        if var_key not in fields:
+            unknown.add(var_key)
+    if len(unknown) > 0:
+        return 'Unknown keys: ' + ', '.join(
+            f'"{var_key}"' for var_key in sorted(unknown))
+    return None
+
+
+def _get_slack_channel_error(slack_client, channel_id):
+    """Checks the given Slack channel id.
+    Returns None if the channel is valid, or the reason that it is invalid.
+    """
+    try:
+        # https://api.slack.com/methods/conversations.info
+        slack_client.conversations_info(channel=channel_id)
+    except SlackApiError as e:
+        response = e.response
+        if not response or response.get('ok', None) is not False:
+            raise
+        reason = response.get('error', None)
+        if reason not in ('channel_not_found', 'missing_scope'):
+            raise
+        return reason
+    return None
+
+
+def _validate_each_slack_channel(slack_client, channels, fmt_error):
+    """Validates the Slack channels with one request per channel, which are
+    sent concurrently.
+    """
+    # several channel names may have the same id, so only check each id once
+    channel_ids = list(dict.fromkeys(channels.values()))
+    with ThreadPoolExecutor(max_workers=SLACK_MAX_WORKERS) as executor:
+        reasons = dict(
+            zip(
+                channel_ids,
+                executor.map(
+                    functools.partial(_get_slack_channel_error, slack_client),
+                    channel_ids)))
+
     errors = []
     for channel, channel_id in channels.items():
-        try:
-            # https://api.slack.com/methods/conversations.info
-            slack_client.conversations_info(channel=channel_id)
-        except SlackApiError as e:
-            if not e.response or e.response.get('ok', None) is not False:
-                raise
-            reason = e.response.get('error', None)
-            if reason is None:
-                raise
-            if reason == 'channel_not_found':
-                errors.append(
-                    fmt_error('Invalid id for Slack channel "{}"', channel))
-            elif reason == 'missing_scope':
+        reason = reasons[channel_id]
+        if reason == 'channel_not_found':
+            errors.append(
+                fmt_error('Invalid id for Slack channel "{}"', channel))
+        elif reason == 'missing_scope':
+            errors.append(
+                fmt_error('Slack key does not have access to channel "{}"',
+                          channel))
+    return errors
+
+
+def _validate_slack_channels(slack_client, channels, used_channels,
+                             fmt_error):
+    """Validates the Slack channels. The bot must be a member of the channels
+    in `used_channels`, which the courses post to; it is only a warning for the
+    other channels.
+    """
+    # list all the channels visible to the Slack key at once instead of
+    # requesting each channel separately
+    # https://api.slack.com/methods/conversations.list
+    # maps: channel id -> whether the bot is a member of the channel
+    visible = {}
+    try:
+        # iterating over the response follows the pagination cursor
+        for page in slack_client.conversations_list(
+                types='public_channel,private_channel', limit=1000):
+            for channel in page['channels']:
+                visible[channel['id']] = channel.get('is_member', True)
+    except SlackApiError as e:
+        if not e.response or e.response.get('ok', None) is not False:
+            raise
+        # the Slack key cannot list every type of channel, or listing (which
+        # has a stricter rate limit) was rate limited, so request each channel
+        # separately instead
+        if e.response.get('error', None) not in ('missing_scope',
+                                                 'ratelimited'):
+            raise
+        return _validate_each_slack_channel(slack_client, channels, fmt_error)
+
+    errors = []
+    # the channels that are not listed: either an invalid id or a private
+    # channel that the Slack key cannot see, which only requesting the channel
+    # can tell apart
+    unlisted = {}
+    for channel, channel_id in channels.items():
+        if channel_id not in visible:
+            unlisted[channel] = channel_id
+        elif not visible[channel_id]:
+            if channel in used_channels:
                 errors.append(
-                    fmt_error('Slack key does not have access to channel "{}"',
+                    fmt_error('Slack bot is not a member of channel "{}"',
                               channel))
             else:
-                raise
+                print('Warning: Slack bot is not a member of channel '
+                      f'"{channel}", which no course posts to')
+    if len(unlisted) > 0:
+        errors += _validate_each_slack_channel(slack_client, unlisted,
+                                               fmt_error)
     return errors
 
 
-def _eastern_to_utc(dt):
-    return EASTERN_TZ.localize(dt).astimezone(UTC_TZ)
+@functools.lru_cache(maxsize=256)
+def _parse_eastern_date(date_str, fmt, delta=NO_DAY):
+    """Parses the given date str in Eastern Time, offset by the given delta,
+    and returns it in UTC. Raises a ValueError if the format is invalid.
+
+    Many assignments share the same dates, so the results are cached.
+    """
+    dt = datetime.strptime(date_str.strip(), fmt) + delta
+    return dt.replace(tzinfo=EASTERN_TZ).astimezone(UTC_TZ)
 
 
-def _valid_date_range(start, end):
+def _valid_date_range(start, end, current):
     if start is None and end is None:
         return True
     if start is None:
-        return now_dt() < end
+        return current < end
     if end is None:
-        return start <= now_dt()
-    return start <= now_dt() < end
+        return start <= current
+    return start <= current < end
 
 
 def _validate_config_course(index, config_course):
     """Validates a course config dict.
-    Returns a message and None if the course is invalid;
-    otherwise, returns None and the course dict.
+    Returns a message, None, and None if the course is invalid;
+    otherwise, returns None, the course name and period, and the course dict.
     """
 
     _invalid_msg = f'Config file has an invalid course format at index {index}'
@@ -115,7 +244,7 @@ def _validate_config_course(index, config_course):
     def invalid(msg=None):
         if msg is None:
             msg = _invalid_msg
-        return msg, None
+        return msg, None, None
 
     if not isinstance(config_course, dict):
         return invalid()
@@ -123,56 +252,47 @@ def _validate_config_course(index, config_course):
     course = {}
 
     # must be strs
-    for key in ('course', 'period', 'channel'):
-        if key not in config_course:
-            return invalid()
-        if not isinstance(config_course[key], str):
+    for key in COURSE_STR_KEYS:
+        value = config_course.get(key, None)
+        if not isinstance(value, str):
             return invalid()
-        course[key] = config_course[key]
+        course[key] = value
+    course_period = course['course'] + ' ' + course['period']
 
     # assignments
-    if 'assignments' not in config_course:
-        return invalid()
-    if not isinstance(config_course['assignments'], list):
+    config_assignments = config_course.get('assignments', None)
+    if not isinstance(config_assignments, list):
         return invalid()
 
     assignments = []
     has_deadline = False
-    for j, config_assignment in enumerate(config_course['assignments']):
+    for j, config_assignment in enumerate(config_assignments):
         _invalid_assignment_msg = _invalid_msg + f', assignment index {j}'
         if not isinstance(config_assignment, dict):
             return invalid(_invalid_assignment_msg)
 
         assignment = {}
-        for key, required in (
-            ('name', True),
-            ('start', False),
-            ('end', False),
-            ('deadline', False),
-        ):
+        for key, required in ASSIGNMENT_STR_KEYS:
             if key not in config_assignment:
                 if not required:
                     assignment[key] = None
                     continue
                 return invalid(_invalid_assignment_msg)
-            if not isinstance(config_assignment[key], str):
+            value = config_assignment[key]
+            if not isinstance(value, str):
                 return invalid(_invalid_assignment_msg)
-            assignment[key] = config_assignment[key]
+            assignment[key] = value
 
-        for key, delta in zip(('start', 'end'), (NO_DAY, ONE_DAY)):
+        for key, delta in ASSIGNMENT_DATE_KEYS:
             date_str = assignment[key]
             if date_str is None:
                 continue
             try:
-                date = datetime.strptime(date_str.strip(), DATE_FMT)
+                assignment[key] = _parse_eastern_date(date_str, DATE_FMT,
+                                                      delta)
             except ValueError:
                 return invalid(_invalid_assignment_msg +
                                ': invalid date format')
-            date += delta
-            assignment[key] = _eastern_to_utc(date)
-
-        assignment['valid_date_range'] = \
-            _valid_date_range(assignment['start'], assignment['end'])
 
         deadline = assignment['deadline']
         if deadline is not None:
@@ -180,19 +300,43 @@ def _validate_config_course(index, config_course):
             assignment['deadline'] = deadline
             has_deadline = True
             try:
-                deadline_dt = datetime.strptime(deadline, DEADLINE_FMT)
+                _parse_eastern_date(deadline, DEADLINE_FMT)
             except ValueError:
                 return invalid(_invalid_assignment_msg +
                                ': invalid deadline format')
-            deadline_utc = _eastern_to_utc(deadline_dt)
-            assignment['passed_deadline'] = now_dt() >= deadline_utc
 
         assignments.append(assignment)
 
     course['assignments'] = assignments
     course['has_deadline'] = has_deadline
 
-    return None, course
+    return None, course_period, course
+
+
+def _update_date_flags(courses):
+    """Sets whether each assignment is currently in its valid date range and
+    whether it has passed its deadline.
+    """
+    # use the same time for every assignment
+    current = now_dt()
+    for course in courses.values():
+        for assignment in course['assignments']:
+            assignment['valid_date_range'] = _valid_date_range(
+                assignment['start'], assignment['end'], current)
+            deadline = assignment['deadline']
+            if deadline is not None:
+                # already parsed during validation, so this is a cache hit
+                deadline_utc = _parse_eastern_date(deadline, DEADLINE_FMT)
+                assignment['passed_deadline'] = current >= deadline_utc
+
+
+def _load_config_file():
+    """Parses the config file."""
+    # use the much faster libyaml parser when it is available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    # the loader detects the encoding of the bytes itself
+    return yaml.load(CONFIG_FILE.read_bytes(), Loader=loader)
 
 
 def read(slack_client, fmt_error=_error):
@@ -210,7 +354,7 @@ def read(slack_client, fmt_error=_error):
         errors.append(fmt_error('Config file "{}" does not exist', CONFIG_FILE))
         return INVALID_RETURN
 
-    config = yaml.safe_load(CONFIG_FILE.read_text(encoding='utf-8'))
+    config = _load_config_file()
 
     # validate highest-level types
     if not isinstance(config, dict):
@@ -240,7 +384,14 @@ def read(slack_client, fmt_error=_error):
                           channel))
             continue
         channels[channel] = channel_id
-    errors += _validate_slack_channels(slack_client, channels, fmt_error)
+    # the channels that the courses post to; invalid sources are reported below
+    used_channels = {
+        config_course.get('channel', None)
+        for config_course in config['sources']
+        if isinstance(config_course, dict)
+    }
+    errors += _validate_slack_channels(slack_client, channels, used_channels,
+                                       fmt_error)
     if len(errors) > 0:
         return INVALID_RETURN
 
@@ -269,7 +420,18 @@ def read(slack_client, fmt_error=_error):
             errors.append(fmt_error('Empty message str for key "{}"', key))
             continue
         messages[key] = message
+        # formatting with test values also checks the format specs (such as
+        # the ".2%" in "{done:.2%}")
         _, error = _try_format(message, **kwargs)
+        if error is not None:
+            # find a clearer reason, such as all the unknown keys instead of
+            # only the first one
+            try:
+                fields_error = _get_fields_error(message, MESSAGES_FIELDS[key])
+            except ValueError as e:
+                fields_error = str(e)
+            if fields_error is not None:
+                error = fields_error
         if error is not None:
             errors.append(
                 fmt_error(
@@ -280,27 +442,28 @@ def read(slack_client, fmt_error=_error):
         return INVALID_RETURN
 
     # read sources
+    channel_names = frozenset(channels)
     courses = {}
     has_deadline = False
     for i, config_course in enumerate(config['sources']):
-        invalid_msg, course = _validate_config_course(i, config_course)
+        invalid_msg, course_period, course = \
+            _validate_config_course(i, config_course)
         if invalid_msg is not None:
             errors.append(fmt_error(invalid_msg))
             continue
-        course_period = course['course'] + ' ' + course['period']
-        if course_period in courses:
-            errors.append(
-                fmt_error('Config file has a repeating course name and period'))
-            continue
-        if course['channel'] not in channels:
+        if course['channel'] not in channel_names:
             errors.append(
                 fmt_error(
                     'Config file has unknown channel name "{}" for course "{}"',
                     course['channel'], course_period))
             continue
+        # only adds the course if the course name and period are new
+        if courses.setdefault(course_period, course) is not course:
+            errors.append(
+                fmt_error('Config file has a repeating course name and period'))
+            continue
         if course.pop('has_deadline'):
             has_deadline = True
-        courses[course_period] = course
     if len(errors) > 0:
         return INVALID_RETURN
 
@@ -310,6 +473,8 @@ def read(slack_client, fmt_error=_error):
                 'Deadlines given in assignments, but missing deadline message'))
         return INVALID_RETURN
 
+    _update_date_flags(courses)
+
     return channels, messages, courses, errors
 
 
@@ -376,12 +541,14 @@ def validate():
             continue
         course = courses[course_period]
         assignments = {assignment.name for assignment in course.assignments}
-        for assignment_data in course_data['assignments']:
-            assignment_name = assignment_data['name']
-            if assignment_name not in assignments:
-                failed = True
-                print(f'Course "{course_period}" does not have an assignment '
-                      f'"{assignment_name}"')
+        config_assignments = {
+            assignment_data['name']
+            for assignment_data in course_data['assignments']
+        }
+        for assignment_name in sorted(config_assignments - assignments):
+            failed = True
+            print(f'Course "{course_period}" does not have an assignment '
+                  f'"{assignment_name}"')
 
     check(not failed)
 
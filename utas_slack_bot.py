@@ -6,12 +6,31 @@ of grading from codePost.
 
 # ==============================================================================
 
-import json
+import base64
+import functools
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    # optional: parses and serializes much faster than the stdlib `json`
+    import orjson
+    from orjson import loads as _load_json
+
+    def _dump_json_bytes(obj):
+        # the submission ids and run indices are ints in memory
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+except ImportError:
+    import json
+
+    def _dump_json_bytes(obj):
+        return json.dumps(obj).encode(encoding='utf-8')
+
+    _load_json = json.loads
+
 import codepost
-from cryptography.fernet import Fernet, InvalidToken
 from slack_sdk.errors import SlackApiError
 
 import read_config
@@ -24,10 +43,41 @@ CACHED_DATA_FOLDER = Path('./data')
 
 ERROR_LOGS_FILE = CACHED_DATA_FOLDER / '_ERRORS.txt'
 
-IGNORE_GRADER_PREFIX = [
+REQUIRED_ENV_VARS = ('CODEPOST_API_KEY', 'SLACK_TOKEN', 'DECRYPTION_KEY')
+
+# The data files store the Fernet tokens either base64-encoded or as their raw
+# bytes, which always start with this version byte. Both are read.
+FERNET_VERSION = b'\x80'
+
+# Whether to write the raw bytes of the Fernet tokens, which are 25% smaller
+# than the base64 form, at the cost of an extra base64 pass each way and binary
+# files. Older versions of the bot can only read the base64 form, so this stays
+# off until they no longer need to read the data.
+STORE_RAW_TOKENS = False
+
+# the maximum number of courses to encrypt or decrypt at once
+MAX_COURSE_WORKERS = 8
+# the maximum number of codePost requests to make at once, across all courses
+MAX_CODEPOST_WORKERS = 8
+
+# the maximum number of notifications to send in one Slack message (each one
+# takes a section block and a divider block, and Slack allows 50 blocks)
+MAX_NOTIFICATIONS_PER_MSG = 25
+# Slack rejects the whole message if the text of any section block is longer
+MAX_SECTION_TEXT_LENGTH = 3000
+
+# removed from the grader emails in the recent graders message
+GRADER_EMAIL_DOMAINS = [
+    'princeton.edu',
+]
+GRADER_EMAIL_SUFFIX_RE = re.compile(
+    '@(?:' + '|'.join(map(re.escape, GRADER_EMAIL_DOMAINS)) + ')$')
+
+# a tuple so that it can be passed directly to `str.startswith()`
+IGNORE_GRADER_PREFIX = (
     # difficult or bad submissions; being held for a reason
     'jdlou+',
-]
+)
 
 # ==============================================================================
 
@@ -77,13 +127,10 @@ def _build_notification_msg(messages, assignment_name, assignment_data,
                             error)
 
     if 'recent_graders' in messages and len(graders_finalized) > 0:
-        graders = []
-        for grader in graders_finalized:
-            # remove "@princeton.edu"
-            grader = grader[:-len('@princeton.edu')]
-            # put in backticks
-            graders.append(f'`{grader}`')
-        graders_str = ', '.join(graders)
+        # remove the email domain and put in backticks
+        graders_str = ', '.join(
+            f'`{GRADER_EMAIL_SUFFIX_RE.sub("", grader)}`'
+            for grader in graders_finalized)
         recent_graders_msg, error = _try_format(messages['recent_graders'],
                                                 graders=graders_str)
         if error is not None:
@@ -99,25 +146,37 @@ def _build_notification_msg(messages, assignment_name, assignment_data,
 
 def send_slack_msg(slack_client, channel_id, msg, as_block=False):
     """Sends a message on Slack to the specified channel. If `as_block` is True,
-    the message is sent as a markdown block.
+    the message is sent as a markdown block, and `msg` may also be a list of
+    messages to send as separate blocks.
 
     Returns the request response, and the error response or None if there was no
     error.
     """
-
     print('sending message to channel:', channel_id)
-    print(msg)
 
     kwargs = {'channel': channel_id}
     if as_block:
-        kwargs['blocks'] = [{
-            'type': 'section',
-            'text': {
-                'type': 'mrkdwn',
-                'text': msg,
-            },
-        }]
+        msgs = [msg] if isinstance(msg, str) else msg
+        blocks = []
+        for block_msg in msgs:
+            print(block_msg)
+            if len(block_msg) > MAX_SECTION_TEXT_LENGTH:
+                # such as a very long list of recent graders
+                block_msg = block_msg[:MAX_SECTION_TEXT_LENGTH - 3] + '...'
+            if len(blocks) > 0:
+                blocks.append({'type': 'divider'})
+            blocks.append({
+                'type': 'section',
+                'text': {
+                    'type': 'mrkdwn',
+                    'text': block_msg,
+                },
+            })
+        kwargs['blocks'] = blocks
+        # fallback for notifications
+        kwargs['text'] = '\n\n'.join(msgs)
     else:
+        print(msg)
         kwargs['text'] = msg
 
     try:
@@ -133,129 +192,154 @@ def send_slack_msg(slack_client, channel_id, msg, as_block=False):
 # ==============================================================================
 
 
+def _migrate_submissions(submissions):
+    """Converts the cached submissions from the older layout, which kept the
+    full history of each submission, to only the last status and grader.
+    The submission ids and run indices are converted from strings to ints.
+    """
+    migrated = {}
+    for submission_id, submission_data in submissions.items():
+        if 'status' in submission_data:
+            migrated_data = submission_data
+        else:
+            # `{run index: {'status': ..., 'grader': ...}}`
+            last_index = max(submission_data.keys(), key=int)
+            migrated_data = {
+                'run': last_index,
+                **submission_data[last_index],
+            }
+        migrated_data['run'] = int(migrated_data['run'])
+        migrated[int(submission_id)] = migrated_data
+    return migrated
+
+
+def _migrate_assignment_data(assignment_data):
+    """Converts the cached data of an assignment from the older layout in
+    place, so that the assignments that are not checked again (such as ones out
+    of their date range) are still saved in the current layout.
+    """
+    if 'last_run' in assignment_data:
+        # already the current layout
+        return
+    assignment_data['last_run'] = max(map(int, assignment_data['runs']),
+                                      default=0)
+    assignment_data['submissions'] = _migrate_submissions(
+        assignment_data['submissions'])
+
+
 def check_assignment_updates(assignment, timestamp_key, cached=None):
     """Checks the codePost assignment for updates, comparing to the cached data.
-    Returns whether to save new data, whether to send a notification, and the
-    new data to store for this assignment.
+    Returns whether to save new data, whether to send a notification, the new
+    data to store for this assignment, and the set of graders who finalized
+    submissions since the cached data.
     """
 
-    def max_int_num(nums, **kwargs):
-        """Returns the maximum number of string numbers."""
-        args = {}
-        if 'default' in kwargs:
-            args['default'] = kwargs['default']
-        return max(nums, key=lambda a: (len(a), tuple(a)), **args)
-
     sent_deadline_message = None
     # maps: run index -> timestamp
     runs = {}
-    index = 1
-    # maps: submission id -> run index ->
-    #   status of "unclaimed", "draft", "finalized", or "deleted"
+    # the largest run index in `runs`
+    last_run = 0
+    # maps: submission id -> the last change of the submission
+    #   "run": the run index where the status or grader changed
+    #   "status": "unclaimed", "draft", "finalized", or "deleted"
+    #   "grader": the grader since that run
     submissions = {}
-    deleted = set()
     if cached is not None:
         sent_deadline_message = cached.get('sent_deadline_message',
                                            sent_deadline_message)
-        runs = cached.get('runs', runs)
-        index = int(max_int_num(runs.keys(), default=0)) + 1
-        submissions = cached.get('submissions', submissions)
-        deleted = set(submissions.keys())
-    index = str(index)
+        # the keys are strings in JSON
+        runs = {
+            int(i): timestamp
+            for i, timestamp in cached.get('runs', runs).items()
+        }
+        # older caches are given a last run index when they are read
+        last_run = cached.get('last_run', last_run)
+        submissions = _migrate_submissions(
+            cached.get('submissions', submissions))
+    index = last_run + 1
 
     updated_status = False
 
     def get_last_status(submission_id):
-        """Returns the last status of the given submission."""
-        NO_STATUS = {'status': 'unknown', 'grader': 'unknown'}
+        """Returns the last status and grader of the given submission."""
+        NO_STATUS = ('unknown', 'unknown')
 
-        submission_data = submissions.get(submission_id, {})
+        submission_data = submissions.get(submission_id, None)
 
-        if len(submission_data) == 0:
+        if submission_data is None:
             return NO_STATUS
 
-        max_key = max_int_num(submission_data.keys())
-        return submission_data[max_key]
+        return submission_data['status'], submission_data['grader']
 
-    def save_status(submission_id, status):
-        """Writes the new status for the given submission."""
+    def save_status(submission_id, status, grader):
+        """Writes the new status and grader for the given submission."""
         nonlocal updated_status
-        if submission_id not in submissions:
-            submissions[submission_id] = {}
-        submission_data = submissions[submission_id]
-        submission_data[index] = status
+        submissions[submission_id] = {
+            'run': index,
+            'status': status,
+            'grader': grader,
+        }
         # when this is called, it is for sure a different status, so we can
         # conclude that the status has been updated
         updated_status = True
 
-    num_total = 0
-    num_finalized = 0
-    num_drafts = 0
-    num_unclaimed = 0
+    # the number of submissions with each status
+    counts = dict.fromkeys(('unclaimed', 'draft', 'finalized'), 0)
+    # the number of drafts held by ignored graders, which are not counted
+    num_ignored = 0
 
     # the graders who finalized between the cached and the current state
     graders_finalized = set()
 
+    # the ids of the submissions that still exist
+    seen = set()
+
     # get info about each submission
     for submission in assignment.list_submissions():
-        submission_id = str(submission.id)
-        deleted.discard(submission_id)
+        submission_id = submission.id
+        seen.add(submission_id)
 
         last_status = get_last_status(submission_id)
 
-        num_total += 1
-        if submission.isFinalized:
-            num_finalized += 1
-            status = 'finalized'
+        status = ('finalized' if submission.isFinalized else
+                  'draft' if submission.grader is not None else 'unclaimed')
+        counts[status] += 1
+        if status == 'finalized':
             # check if it was finalized before
-            if last_status['status'] != 'finalized':
+            if last_status[0] != 'finalized':
                 graders_finalized.add(submission.grader)
-        elif submission.grader is not None:
-            for prefix in IGNORE_GRADER_PREFIX:
-                if submission.grader.startswith(prefix):
-                    # ignore
-                    num_total -= 1
-                    break
-            else:
-                # don't ignore
-                num_drafts += 1
-            status = 'draft'
-        else:
-            num_unclaimed += 1
-            status = 'unclaimed'
+        elif status == 'draft':
+            if submission.grader.startswith(IGNORE_GRADER_PREFIX):
+                num_ignored += 1
 
-        current_status = {
-            'status': status,
-            'grader': submission.grader,
-        }
+        current_status = (status, submission.grader)
 
         if last_status == current_status:
             # it's the same; don't update
             continue
 
-        save_status(submission_id, current_status)
+        save_status(submission_id, *current_status)
 
     # mark as deleted
-    for submission_id in deleted:
-        if submission_id not in submissions:
-            # shouldn't happen, since these keys are taken from the dict
-            continue
-
+    for submission_id in submissions.keys() - seen:
         last_status = get_last_status(submission_id)
 
-        current_status = {
-            'status': 'deleted',
-            'grader': None,
-        }
+        current_status = ('deleted', None)
 
         if last_status == current_status:
             # it's the same; don't update
             continue
 
-        save_status(submission_id, current_status)
+        save_status(submission_id, *current_status)
 
     if updated_status:
         runs[index] = timestamp_key
+        last_run += 1
+
+    num_finalized = counts['finalized']
+    num_drafts = counts['draft'] - num_ignored
+    num_unclaimed = counts['unclaimed']
+    num_total = num_finalized + num_drafts + num_unclaimed
 
     data = {
         'total': num_total,
@@ -264,8 +348,8 @@ def check_assignment_updates(assignment, timestamp_key, cached=None):
         'unclaimed': num_unclaimed,
         'sent_deadline_message': sent_deadline_message,
         'runs': runs,
+        'last_run': last_run,
         'submissions': submissions,
-        'graders_finalized': graders_finalized,
     }
 
     if cached is None:
@@ -274,9 +358,9 @@ def check_assignment_updates(assignment, timestamp_key, cached=None):
     elif updated_status:
         changed = True
     else:
-        changed = any(
-            cached.get(key, None) != data[key]
-            for key in ('total', 'finalized', 'drafts', 'unclaimed'))
+        changed = ((cached.get('total', None), cached.get('finalized', None),
+                    cached.get('drafts', None), cached.get('unclaimed', None))
+                   != (num_total, num_finalized, num_drafts, num_unclaimed))
 
     send_notif = changed
     if num_total == 0 or num_finalized == 0:
@@ -284,22 +368,60 @@ def check_assignment_updates(assignment, timestamp_key, cached=None):
         # notification
         send_notif = False
 
-    return changed, send_notif, data
+    return changed, send_notif, data, graders_finalized
 
 
 # ==============================================================================
 
 
+def _start_assignment_polls(executor, course, assignments, timestamp_key,
+                            cached):
+    """Starts checking the assignments of the codePost course that are in their
+    date range for updates, using the given executor.
+    Returns the mapping of assignment names to the futures of
+    `check_assignment_updates()`.
+    """
+    # only the assignments in their date range are needed; fetching the name of
+    # each assignment and its submissions are separate requests, so they are
+    # done in parallel
+    needed_names = {
+        assignment_info['name']
+        for assignment_info in assignments
+        if assignment_info['valid_date_range']
+    }
+    # maps: assignment name -> future of `check_assignment_updates()`
+    polls = {}
+    all_assignments = course.assignments
+    names = executor.map(lambda a: a.name, all_assignments)
+    try:
+        for name, assignment in zip(names, all_assignments):
+            if name not in needed_names or name in polls:
+                continue
+            polls[name] = executor.submit(check_assignment_updates, assignment,
+                                          timestamp_key, cached.get(name, None))
+            if len(polls) == len(needed_names):
+                # found all the needed assignments
+                break
+    finally:
+        # cancel fetching the names that are no longer needed
+        names.close()
+    return polls
+
+
 def check_course_updates(slack_client,
                          channel,
                          messages,
                          course_period,
-                         course,
                          assignments,
+                         polls,
+                         timestamp_key,
                          cached=None):
-    """Checks the codePost course for updates, comparing to the cached data.
-    Returns the new data to store for this course, whether the data changed, and
-    a list of errors.
+    """Handles the updates of the codePost course, comparing to the cached data.
+    `polls` maps the assignment names to the futures of
+    `check_assignment_updates()`, and `timestamp_key` is the timestamp of this
+    run.
+    Returns the new data to store for this course, whether the data changed, the
+    notification messages to send, and a list of errors.
     """
     if cached is None:
         cached = {}
@@ -307,8 +429,8 @@ def check_course_updates(slack_client,
     data = cached
     changed = False
     errors = []
-
-    course_assignments = {a.name: a for a in course.assignments}
+    # the notifications are sent together after all the courses are checked
+    update_msgs = []
 
     for assignment_info in assignments:
         assignment_name = assignment_info['name']
@@ -316,19 +438,21 @@ def check_course_updates(slack_client,
         if not assignment_info['valid_date_range']:
             print('not in the proper date range')
             continue
-        if assignment_name not in course_assignments:
+        if assignment_name not in polls:
             errors.append(
                 _error('Course "{}" does not have an assignment called "{}"',
                        course_period, assignment_name))
             continue
-        assignment = course_assignments[assignment_name]
-        assignment_cache = cached.get(assignment_name, None)
-
-        timestamp_key = now()
-        assignment_changed, send_notif, assignment_data = (
-            check_assignment_updates(assignment, timestamp_key,
-                                     assignment_cache))
-        graders_finalized = assignment_data.pop('graders_finalized')
+
+        try:
+            (assignment_changed, send_notif, assignment_data,
+             graders_finalized) = polls[assignment_name].result()
+        except Exception as ex:  # pylint: disable=broad-except
+            # keep the cached data for this assignment and go on to the others
+            errors.append(
+                _error('Error while checking assignment "{}" of course "{}": '
+                       '{}', assignment_name, course_period, ex))
+            continue
         data[assignment_name] = assignment_data
         if assignment_changed:
             changed = True
@@ -350,7 +474,7 @@ def check_course_updates(slack_client,
                     # if a deadline message hasn't been sent before, need to
                     # update cached data so that the message doesn't get sent
                     # again
-                    assignment_data['sent_deadline_message'] = now()
+                    assignment_data['sent_deadline_message'] = timestamp_key
                     changed = True
 
         if not send_notif:
@@ -360,59 +484,155 @@ def check_course_updates(slack_client,
             continue
 
         changed = True
-        print('assignment changed: sending notification')
+        print('assignment changed: adding notification')
         update_msg, error = _build_notification_msg(messages, assignment_name,
                                                     assignment_data,
                                                     graders_finalized)
         if error is not None:
             errors.append(error)
         else:
-            # the response doesn't matter
-            _, error = send_slack_msg(slack_client, channel, update_msg)
-            if error is not None:
-                errors.append(_error('Slack API error: {}', error))
+            update_msgs.append(update_msg)
 
-    return data, changed, errors
+    return data, changed, update_msgs, errors
 
 
 # ==============================================================================
 
 
+def _has_assignments_in_range(course_info):
+    return any(assignment_info['valid_date_range']
+               for assignment_info in course_info['assignments'])
+
+
+def _process_course(slack_client,
+                    channel,
+                    messages,
+                    course_period,
+                    course_info,
+                    available_courses,
+                    polls,
+                    poll_exception,
+                    timestamp_key,
+                    cached=None):
+    """Handles the updates of the course. `polls` is the result of
+    `_start_assignment_polls()` for the course, or `poll_exception` is the
+    exception that it raised.
+    Returns the new data to store for this course, whether the data changed, the
+    notification messages to send, and a list of errors.
+    """
+    print('processing course:', course_period)
+    if not _has_assignments_in_range(course_info):
+        # didn't need to contact codePost at all
+        print('no assignments in the proper date range')
+        return cached, False, [], []
+    if (course_info['course'], course_info['period']) not in available_courses:
+        return None, False, [], [
+            _error('Course "{}" with period "{}" could not be found',
+                   course_info['course'], course_info['period'])
+        ]
+    if poll_exception is not None:
+        return None, False, [], [
+            _error(
+                'Error while listing the assignments of course "{}" with '
+                'period "{}": {}', course_info['course'],
+                course_info['period'], poll_exception)
+        ]
+    return check_course_updates(slack_client, channel, messages, course_period,
+                                course_info['assignments'], polls,
+                                timestamp_key, cached)
+
+
 def process_courses(slack_client, config, channels, messages, cached):
     """Processes the assignments in the given courses and sends notifications to
     the specified Slack channel. Returns the new data to store, and a list of
     errors.
+
+    The codePost requests for all the courses share one bounded pool of
+    threads, since almost all of the time is spent waiting on codePost. The
+    results are handled (and Slack messages sent) one course at a time in the
+    order of the config, and the notifications for each channel are sent
+    together once all the courses are processed.
     """
     data = {}
     changed = False
     errors = []
 
-    for course_period, course_info in config.items():
-        print('processing course:', course_period)
-        courses = codepost.course.list_available(name=course_info['course'],
-                                                 period=course_info['period'])
-        if len(courses) == 0:
-            errors.append(
-                _error('Course "{}" with period "{}" could not be found',
-                       course_info['course'], course_info['period']))
-            continue
-        # take the first course if there are duplicates
-        course = courses[0]
-        course_cache = cached.get(course_period, None)
-        course_data, course_changed, course_errors = \
-            check_course_updates(
-                slack_client,
-                channels[course_info['channel']],
-                messages,
-                course_period,
-                course,
-                course_info['assignments'],
-                course_cache)
-        if len(course_errors) > 0:
-            errors += course_errors
-        if course_changed:
-            changed = True
-            data[course_period] = course_data
+    # use the same timestamp for everything in this run
+    timestamp_key = now()
+
+    # codePost always lists all the available courses, so they are only listed
+    # once for all the courses
+    # maps: (course name, period) -> codePost course
+    available_courses = {}
+    if any(map(_has_assignments_in_range, config.values())):
+        for course in codepost.course.list_available():
+            # take the first course if there are duplicates
+            available_courses.setdefault((course.name, course.period), course)
+
+    # maps: channel id -> notification messages
+    notifications = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_CODEPOST_WORKERS) as executor:
+        # start all the courses before handling any of them. nothing is
+        # printed here, so that the log of each course stays together.
+        # maps: course period -> (assignment polls, exception)
+        course_polls = {}
+        for course_period, course_info in config.items():
+            if not _has_assignments_in_range(course_info):
+                continue
+            course = available_courses.get(
+                (course_info['course'], course_info['period']), None)
+            if course is None:
+                continue
+            try:
+                polls = _start_assignment_polls(executor, course,
+                                                course_info['assignments'],
+                                                timestamp_key,
+                                                cached.get(course_period, {}))
+            except Exception as ex:  # pylint: disable=broad-except
+                # reported when the course is handled
+                course_polls[course_period] = None, ex
+            else:
+                course_polls[course_period] = polls, None
+
+        # handle the results in the order of the config
+        for course_period, course_info in config.items():
+            polls, poll_exception = course_polls.get(course_period,
+                                                     (None, None))
+            course_cached = cached.get(course_period, None)
+            course_data, course_changed, update_msgs, course_errors = (
+                _process_course(slack_client, channels[course_info['channel']],
+                                messages, course_period, course_info,
+                                available_courses, polls, poll_exception,
+                                timestamp_key, course_cached))
+            if len(course_errors) > 0:
+                errors += course_errors
+            if course_changed:
+                changed = True
+                data[course_period] = course_data
+            if len(update_msgs) > 0:
+                channel_id = channels[course_info['channel']]
+                notifications.setdefault(channel_id, []).extend(update_msgs)
+
+    # send all the notifications for each channel together
+    for channel_id, update_msgs in notifications.items():
+        for i in range(0, len(update_msgs), MAX_NOTIFICATIONS_PER_MSG):
+            batch_msgs = update_msgs[i:i + MAX_NOTIFICATIONS_PER_MSG]
+            # the response doesn't matter
+            _, error = send_slack_msg(slack_client,
+                                      channel_id,
+                                      batch_msgs,
+                                      as_block=True)
+            if error is None:
+                continue
+            # one bad notification shouldn't lose all the others, so send them
+            # separately as plain text instead
+            print('Slack API error, sending the notifications separately:',
+                  error)
+            for update_msg in batch_msgs:
+                _, error = send_slack_msg(slack_client, channel_id, update_msg)
+                if error is not None:
+                    errors.append(_error('Slack API error: {}', error))
 
     return data, changed, errors
 
@@ -420,6 +640,7 @@ def process_courses(slack_client, config, channels, messages, cached):
 # ==============================================================================
 
 
+@functools.lru_cache(maxsize=None)
 def _get_course_filepath(course_period):
     # very minimal attempt to slugify: remove spaces
     filename = course_period.replace(' ', '_') + '.txt'
@@ -428,29 +649,44 @@ def _get_course_filepath(course_period):
 
 def read_cached_data(crypto, courses):
     """Reads the unencrypted cached data for the given courses."""
+    # not imported at the top, so that `cryptography` is only imported once
+    # `main()` needs `Fernet`
+    from cryptography.fernet import InvalidToken  # pylint: disable=import-outside-toplevel
 
     data = {}
 
-    if not CACHED_DATA_FOLDER.exists():
-        return data, []
-
+    encoded_data = {}
     for course_period in courses.keys():
         filepath = _get_course_filepath(course_period)
-        if not filepath.exists():
+        try:
+            encoded_data[course_period] = filepath.read_bytes()
+        except FileNotFoundError:
+            # no data saved for this course yet
             continue
 
-        encoded_data_bytes = filepath.read_bytes()
+    def decrypt(encoded_data_bytes):
+        if encoded_data_bytes.startswith(FERNET_VERSION):
+            # `Fernet` only accepts the base64 form of the token
+            encoded_data_bytes = base64.urlsafe_b64encode(encoded_data_bytes)
+        course_data = _load_json(crypto.decrypt(encoded_data_bytes))
+        for assignment_data in course_data.values():
+            _migrate_assignment_data(assignment_data)
+        return course_data
+
+    # decrypting is done in C without the GIL, so the courses can be decrypted
+    # in parallel
+    with ThreadPoolExecutor(max_workers=MAX_COURSE_WORKERS) as executor:
+        decoded_data = executor.map(decrypt, encoded_data.values())
         try:
-            decoded_data_bytes = crypto.decrypt(encoded_data_bytes)
+            for course_period, course_data in zip(encoded_data.keys(),
+                                                  decoded_data):
+                data[course_period] = course_data
         except InvalidToken:
             # fail immediately: assume the same key was used for all the saved
             # data
             errors = [_error('Invalid decryption key for stored data')]
             return None, errors
 
-        course_data = json.loads(decoded_data_bytes)
-        data[course_period] = course_data
-
     return data, []
 
 
@@ -460,11 +696,29 @@ def write_data(crypto, data):
     # ensure the folder exists
     CACHED_DATA_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    for course_period, course_data in data.items():
+    def encrypt(course_data):
+        token = crypto.encrypt(_dump_json_bytes(course_data))
+        if STORE_RAW_TOKENS:
+            return base64.urlsafe_b64decode(token)
+        return token
+
+    # encrypting is done in C without the GIL, so the courses can be encrypted
+    # in parallel
+    with ThreadPoolExecutor(max_workers=MAX_COURSE_WORKERS) as executor:
+        encoded_data = executor.map(encrypt, data.values())
+
+    for course_period, encoded_data_bytes in zip(data.keys(), encoded_data):
         filepath = _get_course_filepath(course_period)
-        data_str = json.dumps(course_data)
-        data_bytes = data_str.encode(encoding='utf-8')
-        filepath.write_bytes(crypto.encrypt(data_bytes))
+        # write to a temporary file first so that a crash mid-write can't
+        # leave a corrupted file behind
+        tmp_filepath = filepath.with_name(filepath.name + '.tmp')
+        try:
+            tmp_filepath.write_bytes(encoded_data_bytes)
+            os.replace(tmp_filepath, filepath)
+        finally:
+            # the workflow commits everything in the data folder, so don't
+            # leave the temporary file behind if the write failed
+            tmp_filepath.unlink(missing_ok=True)
 
 
 # ==============================================================================
@@ -472,77 +726,79 @@ def write_data(crypto, data):
 
 def save_errors(errors):
     """Appends the given errors to the errors file."""
-    if ERROR_LOGS_FILE.exists():
-        existing_errors = ERROR_LOGS_FILE.read_text(encoding='utf-8')
-    else:
-        ERROR_LOGS_FILE.parent.mkdir(parents=True, exist_ok=True)
-        existing_errors = ''
-    ERROR_LOGS_FILE.write_text(existing_errors + '\n'.join(errors) + '\n',
-                               encoding='utf-8')
+    ERROR_LOGS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with ERROR_LOGS_FILE.open('a', encoding='utf-8') as f:
+        f.write('\n'.join(errors) + '\n')
 
 
 def main():
+    """Runs the bot. The errors are saved all at once at the end, even if there
+    is an uncaught error.
+    """
     print('Current time:', now())
 
     errors = []
-
-    # read environment variables
-    secrets = {}
-    for name in ('CODEPOST_API_KEY', 'SLACK_TOKEN', 'DECRYPTION_KEY'):
-        secret = os.environ.get(name, None)
-        if secret is None or secret == '':
-            errors.append(
-                _error('Environment variable "{}" could not be found', name))
-        else:
-            secrets[name] = secret
-
-    if len(errors) > 0:
-        save_errors(errors)
-        return
-
-    success = validate_codepost(secrets['CODEPOST_API_KEY'])
-    if not success:
-        errors.append(_error('codePost API key is invalid'))
-
-    success, slack_client = get_slack_client(secrets['SLACK_TOKEN'])
-    if not success:
-        errors.append(_error('Slack API token is invalid'))
-
-    if len(errors) > 0:
-        save_errors(errors)
-        return
-
-    channels, messages, config, errors = read_config.read(slack_client)
-    if len(errors) > 0:
-        save_errors(errors)
-        return
-
-    # TODO: allow changing the key with `MultiFernet`
-    # https://cryptography.io/en/latest/fernet/#cryptography.fernet.MultiFernet.rotate
     try:
-        crypto = Fernet(secrets['DECRYPTION_KEY'])
-    except ValueError:
-        save_errors([_error('Invalid decryption key for stored data')])
-        return
-
-    cached_data, errors = read_cached_data(crypto, config)
-    if len(errors) > 0:
-        save_errors(errors)
-        return
-
-    data, changed, errors = process_courses(slack_client, config, channels,
-                                            messages, cached_data)
-    if len(errors) > 0:
-        save_errors(errors)
-
-    if changed:
-        print('saving new data')
-        write_data(crypto, data)
+        # read environment variables
+        secrets = {
+            name: os.environ.get(name, '') for name in REQUIRED_ENV_VARS
+        }
+        missing = [name for name, secret in secrets.items() if secret == '']
+        if len(missing) > 0:
+            errors += [
+                _error('Environment variable "{}" could not be found', name)
+                for name in missing
+            ]
+            return
+
+        success = validate_codepost(secrets['CODEPOST_API_KEY'])
+        if not success:
+            errors.append(_error('codePost API key is invalid'))
+
+        success, slack_client = get_slack_client(secrets['SLACK_TOKEN'])
+        if not success:
+            errors.append(_error('Slack API token is invalid'))
+
+        if len(errors) > 0:
+            return
+
+        channels, messages, config, config_errors = read_config.read(
+            slack_client)
+        if len(config_errors) > 0:
+            errors += config_errors
+            return
+
+        # only imported once the run gets this far, since it is slow to import
+        from cryptography.fernet import Fernet  # pylint: disable=import-outside-toplevel
+
+        # TODO: allow changing the key with `MultiFernet`
+        # https://cryptography.io/en/latest/fernet/#cryptography.fernet.MultiFernet.rotate
+        try:
+            crypto = Fernet(secrets['DECRYPTION_KEY'])
+        except ValueError:
+            errors.append(_error('Invalid decryption key for stored data'))
+            return
+
+        cached_data, cache_errors = read_cached_data(crypto, config)
+        if len(cache_errors) > 0:
+            errors += cache_errors
+            return
+
+        data, changed, course_errors = process_courses(slack_client, config,
+                                                       channels, messages,
+                                                       cached_data)
+        errors += course_errors
+
+        if changed:
+            print('saving new data')
+            write_data(crypto, data)
+    except Exception as ex:  # pylint: disable=broad-except
+        errors.append(_error('Uncaught error: {}', ex))
+        raise
+    finally:
+        if len(errors) > 0:
+            save_errors(errors)
 
 
 if __name__ == '__main__':
-    try:
-        main()
-    except Exception as ex:  # pylint: disable=broad-except
-        save_errors([_error('Uncaught error: {}', ex)])
-        raise
+    main()
@@ -5,10 +5,10 @@ Shared methods and utilities.
 
 # ==============================================================================
 
-from datetime import datetime
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
 import codepost
-import pytz
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
@@ -22,15 +22,15 @@ __all__ = (
 
 # ==============================================================================
 
-UTC_TZ = pytz.utc
-EASTERN_TZ = pytz.timezone('US/Eastern')
+UTC_TZ = timezone.utc
+EASTERN_TZ = ZoneInfo('America/New_York')
 
 # ==============================================================================
 
 
 def now_dt():
     """Returns the current datetime in UTC."""
-    return UTC_TZ.localize(datetime.utcnow())
+    return datetime.now(UTC_TZ)
 
 
 def now():